@@ -6,6 +6,9 @@ from dotenv import load_dotenv
 from PIL import Image
 from io import BytesIO
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables from a .env file
 load_dotenv()
@@ -17,18 +20,60 @@ HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY", "")
 
 # The endpoint for the free Stable Diffusion model on Hugging Face
 STABLE_DIFFUSION_API_URL = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0"
+# Half the default 50 denoising steps; SDXL output holds up well at 25 and renders ~2x faster
+STABLE_DIFFUSION_PARAMETERS = {"num_inference_steps": 25, "guidance_scale": 6.0}
 
 if not GEMINI_API_KEY:
     print("WARNING: GEMINI_API_KEY environment variable not found.")
 if not HUGGINGFACE_API_KEY:
     print("WARNING: HUGGINGFACE_API_KEY environment variable not found.")
 
+# Sent once per request as Gemini's system instruction rather than repeated inside every prompt
+DM_INSTRUCTIONS = (
+    "You are a text adventure game's Dungeon Master. "
+    "Describe each scene in a vivid, engaging style and keep the story consistent with everything that came before. "
+    "End every response by giving the user two clear choices, labeled A and B."
+)
+VISUAL_PROMPT_INSTRUCTIONS = (
+    "You are an AI assistant that creates safe, simple, and concise image generation prompts. "
+    "Based on the fantasy story scene you are given, create a very short, clean, descriptive prompt. "
+    "It must be under 20 words. "
+    "Style: beautiful digital art, fantasy, cinematic lighting."
+)
+OPENING_TURN = "My character and setting is: '{idea}'. Describe the opening scene."
+CHOICE_TURNS = {choice: f"I choose {choice}. Describe the outcome and the new scene." for choice in "AB"}
+
+# Only the most recent messages are sent verbatim; older ones are folded into a running summary
+HISTORY_WINDOW = 20
+SUMMARY_BATCH = 10
+SUMMARY_INSTRUCTIONS = (
+    "You keep notes for a text adventure game. Summarize the story so far in at most 3 sentences, "
+    "keeping the character, where they are, their goals and any unresolved threads."
+)
+
+# Each thread (main loop, illustrator, summarizer) keeps its own session, since requests.Session
+# is not thread-safe; each one still reuses its connections to Gemini and Hugging Face between turns
+thread_state = threading.local()
+
+def get_session():
+    if not hasattr(thread_state, "session"):
+        thread_state.session = requests.Session()
+    return thread_state.session
+
+# --- Helper function to build one turn of a Gemini conversation ---
+def gemini_turn(role, text):
+    return {"role": role, "parts": [{"text": text}]}
+
 # --- Helper function to call the Gemini Text API ---
-def call_gemini_api(prompt):
+def call_gemini_api(contents, system_instruction=None):
+    if isinstance(contents, str):
+        contents = [gemini_turn("user", contents)]
     headers = {"Content-Type": "application/json"}
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    payload = {"contents": contents}
+    if system_instruction:
+        payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
     try:
-        response = requests.post(f"{GEMINI_API_URL}{GEMINI_API_KEY}", headers=headers, data=json.dumps(payload))
+        response = get_session().post(f"{GEMINI_API_URL}{GEMINI_API_KEY}", headers=headers, data=json.dumps(payload))
         response.raise_for_status()
         data = response.json()
         if data.get('candidates'):
@@ -42,14 +87,7 @@ def call_gemini_api(prompt):
 # --- Function to Generate a Visual Prompt ---
 def generate_visual_prompt(story_text):
     print("...AI is creating a visual prompt...")
-    prompt = (
-        "You are an AI assistant that creates safe, simple, and concise image generation prompts. "
-        "Based on the following fantasy story scene, create a very short, clean, descriptive prompt. "
-        "It must be under 20 words. "
-        "Style: beautiful digital art, fantasy, cinematic lighting. "
-        f"Scene: '{story_text}'"
-    )
-    visual_prompt = call_gemini_api(prompt)
+    visual_prompt = call_gemini_api(f"Scene: '{story_text}'", VISUAL_PROMPT_INSTRUCTIONS)
     cleaned_prompt = visual_prompt.replace('\n', ' ').replace('*', '').strip()
     print(f"Generated Visual Prompt: {cleaned_prompt}")
     return cleaned_prompt
@@ -62,10 +100,10 @@ def generate_image_with_stable_diffusion(visual_prompt):
         
     print("...AI is generating the illustration with Stable Diffusion...")
     headers = {"Authorization": f"Bearer {HUGGINGFACE_API_KEY}"}
-    payload = {"inputs": visual_prompt}
+    payload = {"inputs": visual_prompt, "parameters": STABLE_DIFFUSION_PARAMETERS}
     
     try:
-        response = requests.post(STABLE_DIFFUSION_API_URL, headers=headers, json=payload)
+        response = get_session().post(STABLE_DIFFUSION_API_URL, headers=headers, json=payload)
         response.raise_for_status()
         
         # The response is the raw image data
@@ -87,6 +125,37 @@ def generate_image_with_stable_diffusion(visual_prompt):
             print(f"Error details: {e.response.text}")
         return None
 
+# --- Function to Illustrate a Scene ---
+def illustrate_scene(scene_text, scene_number):
+    visual_prompt = generate_visual_prompt(scene_text)
+    image = generate_image_with_stable_diffusion(visual_prompt)
+    if image:
+        image_path = f"scene_{scene_number}.png"
+        image.save(image_path)
+        print(f"Illustration saved to {image_path}")
+
+# --- Function to Fold Older Turns into the Story Summary ---
+def summarize_story(summary, turns):
+    story = "\n\n".join(
+        f"{'Player' if turn['role'] == 'user' else 'Dungeon Master'}: {turn['parts'][0]['text']}" for turn in turns
+    )
+    try:
+        new_summary = call_gemini_api(
+            f"Summary so far: {summary or 'The story has just begun.'}\n\nWhat happened next:\n{story}",
+            SUMMARY_INSTRUCTIONS,
+        )
+    except Exception as e:  # e.g. a blocked candidate with no content
+        print(f"Story summary failed: {e}")
+        return None
+    if new_summary.startswith("Error:"):
+        return None
+    return new_summary
+
+def story_instructions(summary):
+    if not summary:
+        return DM_INSTRUCTIONS
+    return f"{DM_INSTRUCTIONS}\n\nSummary of the story so far: {summary}"
+
 # --- Main Game Loop ---
 def main_game_loop():
     print("="*50)
@@ -94,27 +163,22 @@ def main_game_loop():
     print("="*50)
     
     user_idea = input("Enter your character and setting (e.g., 'a knight in a haunted forest'):\n> ")
-    story_history = [f"The user's character is {user_idea}."]
+    # The recent story as alternating user/model turns, plus a summary of everything older
+    gemini_contents = deque([gemini_turn("user", OPENING_TURN.format(idea=user_idea))])
+    summary = ""
+    summarized_turns = []  # Turns being folded into the summary while the player reads
+    summary_future = None
     scene_counter = 0
     
-    initial_prompt = (
-        "You are a text adventure game's Dungeon Master. "
-        f"The user's character and setting is: '{user_idea}'. "
-        "Describe the opening scene in a vivid, engaging style. "
-        "End your response by giving the user two clear choices, labeled A and B."
-    )
-    
     print("\n...AI is thinking...")
-    scene_text = call_gemini_api(initial_prompt)
-    story_history.append(f"AI Scene: {scene_text}")
+    scene_text = call_gemini_api(list(gemini_contents), DM_INSTRUCTIONS)
+    gemini_contents.append(gemini_turn("model", scene_text))
     
-    visual_prompt = generate_visual_prompt(scene_text)
-    image = generate_image_with_stable_diffusion(visual_prompt)
-    if image:
-        scene_counter += 1
-        image_path = f"scene_{scene_counter}.png"
-        image.save(image_path)
-        print(f"Illustration saved to {image_path}")
+    # Illustrations render in the background while the player reads and chooses
+    illustrator = ThreadPoolExecutor(max_workers=1)
+    summarizer = ThreadPoolExecutor(max_workers=1)
+    scene_counter += 1
+    illustrator.submit(illustrate_scene, scene_text, scene_counter)
     
     while True:
         print("\n" + "="*50 + "\n")
@@ -125,32 +189,35 @@ def main_game_loop():
         
         if user_choice == 'QUIT':
             print("\nThanks for playing!")
+            summarizer.shutdown(wait=False, cancel_futures=True)
+            illustrator.shutdown(wait=True)  # Let the last illustration finish saving
             break
         
         if user_choice not in ['A', 'B']:
             print("\nInvalid choice. Please enter A or B.")
             continue
             
-        story_history.append(f"User chose: {user_choice}")
+        # Only the choice is new; earlier turns are already in the conversation
+        gemini_contents.append(gemini_turn("user", CHOICE_TURNS[user_choice]))
         
-        next_prompt = (
-            "You are a text adventure game's Dungeon Master. Continue the story based on the user's last choice. "
-            "Describe the outcome and the new scene. Keep it consistent and engaging. "
-            "End with two new, clear choices, labeled A and B. "
-            f"Here is the story so far:\n{' '.join(story_history)}"
-        )
+        if summary_future:
+            new_summary = summary_future.result()
+            if new_summary is None:  # Summarizing failed, so keep sending those turns verbatim
+                gemini_contents.extendleft(reversed(summarized_turns))
+            else:
+                summary = new_summary
+            summary_future = None
         
         print("\n...AI is thinking...")
-        scene_text = call_gemini_api(next_prompt)
-        story_history.append(f"AI Scene: {scene_text}")
+        scene_text = call_gemini_api(list(gemini_contents), story_instructions(summary))
+        gemini_contents.append(gemini_turn("model", scene_text))
+        
+        if len(gemini_contents) >= HISTORY_WINDOW + SUMMARY_BATCH:
+            summarized_turns = [gemini_contents.popleft() for _ in range(SUMMARY_BATCH)]
+            summary_future = summarizer.submit(summarize_story, summary, summarized_turns)
         
-        visual_prompt = generate_visual_prompt(scene_text)
-        image = generate_image_with_stable_diffusion(visual_prompt)
-        if image:
-            scene_counter += 1
-            image_path = f"scene_{scene_counter}.png"
-            image.save(image_path)
-            print(f"Illustration saved to {image_path}")
+        scene_counter += 1
+        illustrator.submit(illustrate_scene, scene_text, scene_counter)
 
 if __name__ == "__main__":
     main_game_loop()
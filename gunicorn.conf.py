@@ -0,0 +1,15 @@
+import multiprocessing
+import os
+
+# Each game's state lives in its WebSocket coroutine, so a connection never has to
+# move between workers and the app scales by simply running one worker per core.
+bind = "0.0.0.0:8000"
+worker_class = "uvicorn_worker.UvicornWorker"  # Picks up uvloop and httptools when installed
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Heartbeat timeout, not a request timeout: seconds a worker may go without checking in before
+# the arbiter restarts it. Workers only check in once lifespan startup has finished.
+timeout = 120
+if os.getenv("STABLE_DIFFUSION_LOCAL") == "1":
+    workers = 1  # Every worker would load its own copy of SDXL onto the GPU
+    timeout = 1800  # Startup downloads and loads SDXL, which can take many minutes
+graceful_timeout = 30
@@ -1,150 +1,561 @@
 import os
 import asyncio
+import hashlib
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from dotenv import load_dotenv
-import requests
-import json
+import anyio
+import httpx
+import orjson
+import numpy as np
 from PIL import Image
 from io import BytesIO
-import base64
 
 # Load environment variables
 load_dotenv()
 
 # --- Configuration ---
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key="
+GEMINI_STREAM_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:streamGenerateContent?alt=sse&key="
+GEMINI_EMBED_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/text-embedding-004:embedContent?key="
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY", "")
-STABLE_DIFFUSION_API_URL = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0"
+STABLE_DIFFUSION_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+STABLE_DIFFUSION_API_URL = f"https://api-inference.huggingface.co/models/{STABLE_DIFFUSION_MODEL}"
+# Set STABLE_DIFFUSION_LOCAL=1 on a CUDA host (with torch and diffusers installed) to render
+# with a self-hosted fp16 pipeline instead of the Hugging Face Inference API
+STABLE_DIFFUSION_LOCAL = os.getenv("STABLE_DIFFUSION_LOCAL") == "1"
+SD_BATCH_MAX = 8  # Max prompts rendered together in one local pipeline call
+SD_BATCH_WINDOW = 0.05  # Seconds to wait for more prompts before rendering a batch
+# Half the default 50 denoising steps; SDXL output holds up well at 25 and renders ~2x faster
+STABLE_DIFFUSION_PARAMETERS = {"num_inference_steps": 25, "guidance_scale": 6.0}
+GEMINI_ERROR_TEXT = "Error: The AI storyteller is currently unavailable."
+VISUAL_PROMPT_CACHE_SIZE = 256  # Max cached scene -> visual prompt entries
+IMAGE_CACHE_SIZE = 128  # Max cached illustrations
+IMAGE_CACHE_THRESHOLD = 0.9  # Cosine similarity above which a cached illustration is reused
+HISTORY_WINDOW = 20  # Most recent messages (player choices + scenes) sent to Gemini verbatim
+SUMMARY_BATCH = 10  # Older messages folded into the running story summary per summarization call
+MAX_SPECULATIVE_CALLS = 16  # In-flight speculative scenes per worker; beyond this, turns are generated on demand
+MAX_ACTIVE_GAMES = 32  # Concurrent games per worker; further players wait in line
+KEEPALIVE_EXPIRY = 300  # Seconds an idle API connection stays open; players think far longer than httpx's 5s default
+WARM_UP_TIMEOUT = 5  # Seconds allowed for each startup warm-up request
+THREADPOOL_LIMIT = 200  # Worker threads for blocking calls (anyio defaults to 40)
+VISUAL_PROMPT_PREFIX_CHARS = 300  # Streamed scene text needed before illustrating it (roughly the opening paragraph)
+
+# Sent once per request as Gemini's system instruction rather than repeated inside every prompt
+DM_INSTRUCTIONS = (
+    "You are a text adventure game's Dungeon Master. "
+    "Describe each scene vividly and keep the story consistent with everything that came before. "
+    "Your response MUST end with two clear choices for the user, formatted exactly as 'A) [Choice text]' and 'B) [Choice text]' on separate lines."
+)
+VISUAL_PROMPT_INSTRUCTIONS = (
+    "You are an AI assistant creating image prompts. Based on the scene you are given, "
+    "create a short, descriptive prompt under 20 words. "
+    "Style: beautiful digital art, fantasy, cinematic lighting."
+)
+OPENING_TURN = "My character and setting is: '{idea}'. Describe the opening scene."
+CHOICE_TURNS = {choice: f"I choose {choice}. Describe the outcome and the new scene." for choice in "AB"}
+SUMMARY_INSTRUCTIONS = (
+    "You keep notes for a text adventure game. Summarize the story so far in at most 3 sentences, "
+    "keeping the character, where they are, their goals and any unresolved threads."
+)
+
+# --- Shared HTTP Client ---
+# One pooled HTTP/2 client for every Gemini and Hugging Face call, so turns reuse
+# open TLS connections instead of handshaking (and borrowing a worker thread) per request.
+http_client: httpx.AsyncClient | None = None
+
+async def warm_up_connections():  # Resolve DNS and finish TLS handshakes before the first player arrives
+    hosts = ["https://generativelanguage.googleapis.com/"]
+    if not STABLE_DIFFUSION_LOCAL:
+        hosts.append("https://api-inference.huggingface.co/")
+    # Short timeout: an unreachable host must not hold up worker startup
+    await asyncio.gather(*(http_client.head(host, timeout=WARM_UP_TIMEOUT) for host in hosts), return_exceptions=True)
+
+# --- Local Stable Diffusion ---
+sd_pipeline = None
+sd_queue: asyncio.Queue | None = None  # (visual prompt, future) pairs waiting for the batcher
+sd_executor = ThreadPoolExecutor(max_workers=1)  # One GPU, so batches run one at a time
+
+def load_stable_diffusion_pipeline():  # Load SDXL in fp16 onto the GPU
+    import torch
+    from diffusers import StableDiffusionXLPipeline
+    pipeline = StableDiffusionXLPipeline.from_pretrained(
+        STABLE_DIFFUSION_MODEL, torch_dtype=torch.float16, variant="fp16", use_safetensors=True
+    ).to("cuda")
+    try:
+        pipeline.enable_xformers_memory_efficient_attention()
+    except (ImportError, ValueError):
+        pass  # Without xformers, torch 2 already uses SDPA flash attention
+    return pipeline
+
+def render_images_locally(visual_prompts):  # Blocking; only call on sd_executor
+    return sd_pipeline(visual_prompts, **STABLE_DIFFUSION_PARAMETERS).images
+
+async def sd_batcher():  # Coalesce concurrent players' prompts into one denoising loop
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await sd_queue.get()]
+        deadline = loop.time() + SD_BATCH_WINDOW
+        while len(batch) < SD_BATCH_MAX and (remaining := deadline - loop.time()) > 0:
+            try:
+                batch.append(await asyncio.wait_for(sd_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        batch = [(prompt, future) for prompt, future in batch if not future.cancelled()]  # Players who moved on
+        if not batch: continue
+        try:
+            images = await loop.run_in_executor(sd_executor, render_images_locally, [prompt for prompt, _ in batch])
+        except Exception as e:
+            print(f"Image generation failed: {e}")
+            images = [None] * len(batch)
+        for (_, future), image in zip(batch, images):
+            if not future.done(): future.set_result(image)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, sd_pipeline, sd_queue
+    # Starlette runs blocking work (static files, sync endpoints) on anyio's shared thread pool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_LIMIT
+    http_client = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=1,  # Retry a failed connect once instead of failing the turn
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=KEEPALIVE_EXPIRY),
+        ),
+        headers={"Content-Type": "application/json"},  # Every request body is JSON, serialized with orjson
+        timeout=120,  # SDXL renders can take well over a minute on a cold model
+    )
+    await warm_up_connections()
+    if STABLE_DIFFUSION_LOCAL:
+        sd_pipeline = await asyncio.get_running_loop().run_in_executor(sd_executor, load_stable_diffusion_pipeline)
+        sd_queue = asyncio.Queue()
+        batcher_task = asyncio.create_task(sd_batcher())
+    yield
+    if sd_pipeline:
+        batcher_task.cancel()
+    await http_client.aclose()
 
 # --- Initialize FastAPI App ---
 app = FastAPI(
     title="Project Elysium API",
-    description="An AI-powered interactive storytelling game."
+    description="An AI-powered interactive storytelling game.",
+    lifespan=lifespan,
 )
 
 # --- Core AI Functions ---
 
-async def call_gemini_api_async(prompt):  # Call Gemini API asynchronously
-    loop = asyncio.get_event_loop()  # Get the current event loop
-    return await loop.run_in_executor(None, call_gemini_api, prompt) 
+def gemini_turn(role, text):  # One entry of a Gemini multi-turn "contents" list
+    return {"role": role, "parts": [{"text": text}]}
+
+def gemini_payload(contents, system_instruction=None):  # Request body shared by the Gemini endpoints
+    if isinstance(contents, str):  # A bare prompt is a single user turn
+        contents = [gemini_turn("user", contents)]
+    payload = {"contents": contents}
+    if system_instruction:
+        payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+    return payload
 
-def call_gemini_api(prompt):  # Call Gemini API
-    headers = {"Content-Type": "application/json"}
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+async def call_gemini_api_async(contents, system_instruction=None):  # Call Gemini API asynchronously
+    payload = gemini_payload(contents, system_instruction)
     try:
-        response = requests.post(f"{GEMINI_API_URL}{GEMINI_API_KEY}", headers=headers, data=json.dumps(payload))
+        response = await http_client.post(f"{GEMINI_API_URL}{GEMINI_API_KEY}", content=orjson.dumps(payload))
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         if data.get('candidates'):  # Check if there are any candidates
             return data['candidates'][0]['content']['parts'][0]['text']
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
+        print(f"Text API Call Error: {e}")
+    return GEMINI_ERROR_TEXT
+
+class SceneStreamError(Exception):
+    """A streamed Gemini reply failed part-way or produced no text (e.g. it was safety-blocked)."""
+
+async def stream_gemini_api_async(contents, system_instruction=None):  # Yield text chunks as Gemini generates them
+    payload = gemini_payload(contents, system_instruction)
+    received_text = False
+    try:
+        async with http_client.stream("POST", f"{GEMINI_STREAM_API_URL}{GEMINI_API_KEY}", content=orjson.dumps(payload)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():  # Server-sent events, one JSON chunk per "data:" line
+                if not line.startswith("data:"): continue
+                data = orjson.loads(line[len("data:"):])
+                if data.get('candidates'):
+                    for part in data['candidates'][0].get('content', {}).get('parts', []):
+                        if part.get('text'):
+                            received_text = True
+                            yield part['text']
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
         print(f"Text API Call Error: {e}")
-    return "Error: The AI storyteller is currently unavailable."
+        raise SceneStreamError(str(e)) from e
+    if not received_text:  # The stream ended cleanly but without a scene, e.g. finishReason SAFETY
+        print("Text API Call Error: Gemini returned no text")
+        raise SceneStreamError("Gemini returned no text")
+
+# --- Visual Prompt Cache ---
+# Keyed on a digest of the scene text; each entry is [visual prompt, hits, seconds it took to generate].
+visual_prompt_cache: dict[str, list] = {}
+
+def evict_visual_prompt():  # Drop the entry whose hits x latency saves the least (LCBFU)
+    victim = min(visual_prompt_cache, key=lambda k: (visual_prompt_cache[k][1] + 1) * visual_prompt_cache[k][2])
+    del visual_prompt_cache[victim]
 
 async def generate_visual_prompt_async(story_text):  # Generate visual prompt asynchronously
-    prompt = (
-        "You are an AI assistant creating image prompts. Based on the following scene, "
-        "create a short, descriptive prompt under 20 words. "
-        "Style: beautiful digital art, fantasy, cinematic lighting. "
-        f"Scene: '{story_text}'"
-    )
-    visual_prompt = await call_gemini_api_async(prompt)  # Call Gemini API asynchronously
-    return visual_prompt.replace('\n', ' ').replace('*', '').strip()  # Clean up the visual prompt
+    key = hashlib.blake2b(story_text.encode(), digest_size=16).hexdigest()
+    entry = visual_prompt_cache.get(key)
+    if entry:  # Same scene seen before, skip the Gemini round-trip
+        entry[1] += 1
+        return entry[0]
+    started = time.perf_counter()
+    visual_prompt = await call_gemini_api_async(f"Scene: '{story_text}'", VISUAL_PROMPT_INSTRUCTIONS)  # Call Gemini API asynchronously
+    cleaned_prompt = visual_prompt.replace('\n', ' ').replace('*', '').strip()  # Clean up the visual prompt
+    if visual_prompt != GEMINI_ERROR_TEXT:  # Never cache failures
+        if len(visual_prompt_cache) >= VISUAL_PROMPT_CACHE_SIZE:
+            evict_visual_prompt()
+        visual_prompt_cache[key] = [cleaned_prompt, 0, time.perf_counter() - started]
+    return cleaned_prompt
+
+async def embed_text_async(text):  # Embed text with Gemini, normalized to unit length
+    payload = {"model": "models/text-embedding-004", "content": {"parts": [{"text": text}]}}
+    try:
+        response = await http_client.post(f"{GEMINI_EMBED_API_URL}{GEMINI_API_KEY}", content=orjson.dumps(payload))
+        response.raise_for_status()
+        values = np.asarray(orjson.loads(response.content)['embedding']['values'], dtype=np.float32)
+        norm = np.linalg.norm(values)
+        if norm > 0:  # A zero vector can't be normalized; render uncached instead
+            return values / norm
+    except (httpx.HTTPError, KeyError, ValueError) as e:  # ValueError covers orjson.JSONDecodeError
+        print(f"Embedding API Call Error: {e}")
+    return None
+
+# --- Image Cache ---
+
+class ImageCache:
+    """Illustrations keyed by the embedding of their visual prompt.
 
-async def generate_image_async(visual_prompt):
-    loop = asyncio.get_event_loop() 
-    return await loop.run_in_executor(None, generate_image_with_stable_diffusion, visual_prompt) 
+    A lookup returns the cached image whose prompt is most similar to the new one,
+    provided the cosine similarity clears the threshold. When full, the entry whose
+    hits x generation latency saves the least is evicted (LCBFU).
+    """
 
-def generate_image_with_stable_diffusion(visual_prompt):
-    if not HUGGINGFACE_API_KEY: return None
+    def __init__(self, size, threshold):
+        self.size = size
+        self.threshold = threshold
+        self.embeddings: np.ndarray | None = None  # (N, dim) unit vectors, one row per image
+        self.images: list[bytes] = []  # Encoded WebP files
+        self.hits: list[int] = []
+        self.costs: list[float] = []  # Seconds each image took to generate
+
+    def lookup(self, embedding):
+        if not self.images: return None
+        similarities = self.embeddings @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold: return None
+        self.hits[best] += 1
+        return self.images[best]
+
+    def add(self, embedding, image, cost):
+        if len(self.images) >= self.size:
+            victim = int(np.argmin((np.asarray(self.hits) + 1) * np.asarray(self.costs)))
+            self.embeddings = np.delete(self.embeddings, victim, axis=0)
+            del self.images[victim], self.hits[victim], self.costs[victim]
+        row = embedding[np.newaxis, :]
+        self.embeddings = row if self.embeddings is None else np.vstack([self.embeddings, row])
+        self.images.append(image)
+        self.hits.append(0)
+        self.costs.append(cost)
+
+image_cache = ImageCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_THRESHOLD)
+
+async def render_image_api_async(visual_prompt):  # Render through the Hugging Face Inference API
     headers = {"Authorization": f"Bearer {HUGGINGFACE_API_KEY}"}
-    payload = {"inputs": visual_prompt}
+    payload = {"inputs": visual_prompt, "parameters": STABLE_DIFFUSION_PARAMETERS}
     try:
-        response = requests.post(STABLE_DIFFUSION_API_URL, headers=headers, json=payload)
+        response = await http_client.post(STABLE_DIFFUSION_API_URL, headers=headers, content=orjson.dumps(payload))
         response.raise_for_status()  # Check for HTTP errors
-        image = Image.open(BytesIO(response.content))  # Open the image
-        buffered = BytesIO()  # Create a buffer
-        image.save(buffered, format="PNG")  # Save the image to the buffer
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")  # Encode the image to base64
-        return img_str
-    except requests.exceptions.RequestException as e:
+        return response.content  # The raw image file; decoded off the event loop in encode_image
+    except httpx.HTTPError as e:
         print(f"Image generation failed: {e}")
     return None
 
+async def render_image_local_async(visual_prompt):  # Render on the local pipeline via the batcher
+    future = asyncio.get_running_loop().create_future()
+    await sd_queue.put((visual_prompt, future))
+    return await future
+
+def encode_image(image):  # Blocking PIL work; run in a worker thread
+    if isinstance(image, bytes):
+        image = Image.open(BytesIO(image))  # Open the image
+    buffered = BytesIO()  # Create a buffer
+    image.convert("RGB").save(buffered, format="WEBP", quality=85, method=4)  # Far smaller than PNG for painterly scenes
+    return buffered.getvalue()
+
+async def generate_image_async(visual_prompt):  # Generate an image with Stable Diffusion
+    if not (sd_pipeline or HUGGINGFACE_API_KEY): return None
+    embedding = await embed_text_async(visual_prompt)
+    if embedding is not None:
+        cached_image = image_cache.lookup(embedding)
+        if cached_image: return cached_image  # A similar scene was already illustrated
+    started = time.perf_counter()
+    if sd_pipeline:
+        image = await render_image_local_async(visual_prompt)
+    else:
+        image = await render_image_api_async(visual_prompt)
+    if not image: return None
+    image_bytes = await asyncio.to_thread(encode_image, image)
+    if embedding is not None:
+        image_cache.add(embedding, image_bytes, time.perf_counter() - started)
+    return image_bytes
+
+# --- WebSocket Messages ---
+# JSON frames go through orjson rather than Starlette's stdlib-json send_json/receive_json.
+# They stay text frames; binary frames are reserved for image data.
+
+async def send_message(websocket: WebSocket, message):
+    await websocket.send_text(orjson.dumps(message).decode())
+
+async def receive_message(websocket: WebSocket):
+    return orjson.loads(await websocket.receive_text())
+
+async def wait_for_disconnect(websocket: WebSocket):  # Returns once the client closes the socket
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+async def send_scene_image(websocket: WebSocket, scene_text):  # Illustrate a scene off the critical path
+    visual_prompt = await generate_visual_prompt_async(scene_text)
+    image_bytes = await generate_image_async(visual_prompt)
+    if image_bytes:
+        # Announce the format, then send the file itself as a binary frame (no base64 overhead)
+        await send_message(websocket, {"type": "image_incoming", "mime": "image/webp"})
+        await websocket.send_bytes(image_bytes)
+
+# --- Story Context ---
+
+class StoryContext:
+    """What Gemini sees of a game: recent turns verbatim, older ones as a running summary.
+
+    Once the window is full, the oldest messages move to a pending list and are folded
+    into the summary by a background Gemini call every SUMMARY_BATCH messages. Pending
+    messages are still sent verbatim until their summary lands, so nothing is dropped.
+    """
+
+    def __init__(self):
+        self.recent = deque()  # Alternating user/model turns, oldest first
+        self.pending = []  # Turns pushed out of the window, awaiting summarization
+        self.summary = ""
+        self.summary_task = None
+
+    def append(self, role, text):
+        self.recent.append(gemini_turn(role, text))
+        if role != "model": return  # Only trim whole exchanges so contents always start with a user turn
+        while len(self.recent) > HISTORY_WINDOW:
+            self.pending.append(self.recent.popleft())
+        if len(self.pending) >= SUMMARY_BATCH and not self.summary_task:
+            self.summary_task = asyncio.create_task(self.summarize(len(self.pending)))
+
+    async def summarize(self, count):  # Fold the first `count` pending turns into the summary
+        story = "\n\n".join(
+            f"{'Player' if turn['role'] == 'user' else 'Dungeon Master'}: {turn['parts'][0]['text']}"
+            for turn in self.pending[:count]
+        )
+        try:
+            summary = await call_gemini_api_async(
+                f"Summary so far: {self.summary or 'The story has just begun.'}\n\nWhat happened next:\n{story}",
+                SUMMARY_INSTRUCTIONS,
+            )
+            if summary != GEMINI_ERROR_TEXT:  # On failure keep the turns and retry after the next scene
+                self.summary = summary
+                del self.pending[:count]
+        except Exception as e:  # e.g. a blocked candidate with no content
+            print(f"Story summary failed: {e}")
+        finally:
+            self.summary_task = None  # Always allow the next scene to retry
+
+    def retract(self):  # Forget the last player turn when Gemini failed to answer it
+        self.recent.pop()
+
+    def contents(self):
+        return self.pending + list(self.recent)
+
+    def system_instruction(self):
+        if not self.summary: return DM_INSTRUCTIONS
+        return f"{DM_INSTRUCTIONS}\n\nSummary of the story so far: {self.summary}"
+
+    def close(self):
+        if self.summary_task: self.summary_task.cancel()
+
+async def stream_scene(websocket: WebSocket, story: StoryContext):  # Forward a new scene to the player as it is written
+    scene_text = ""
+    image_task = None
+    try:
+        for attempt in range(2):
+            try:
+                async for delta in stream_gemini_api_async(story.contents(), story.system_instruction()):
+                    scene_text += delta
+                    await send_message(websocket, {"type": "story_delta", "text": delta})
+                    if not image_task and len(scene_text) >= VISUAL_PROMPT_PREFIX_CHARS:
+                        # Start illustrating from the opening lines while the rest of the scene streams in
+                        image_task = asyncio.create_task(send_scene_image(websocket, scene_text))
+                break
+            except SceneStreamError:
+                if not scene_text and not attempt: continue  # Nothing reached the player yet, so retry once
+                # A partial scene is already on screen (or the retry failed too): have the browser
+                # drop it and report the error, and return None so it never enters the story context
+                if image_task: image_task.cancel()
+                await send_message(websocket, {"type": "error", "text": GEMINI_ERROR_TEXT})
+                return None, None
+        await send_message(websocket, {"type": "story", "text": scene_text})
+        if not image_task:
+            image_task = asyncio.create_task(send_scene_image(websocket, scene_text))
+    except BaseException:
+        if image_task: image_task.cancel()
+        raise
+    return scene_text, image_task
+
+async def send_scene(websocket: WebSocket, scene_text):  # Deliver a scene that was written ahead of time
+    await send_message(websocket, {"type": "story", "text": scene_text})
+    return asyncio.create_task(send_scene_image(websocket, scene_text))
+
+# --- Speculative Scenes ---
+# While the player reads, both possible next scenes are written in the background, so the
+# chosen one is usually ready (or nearly so) when the choice arrives.
+speculative_calls = 0
+
+def release_speculation(task):  # Done callback; runs even if the task is cancelled before it starts
+    global speculative_calls
+    speculative_calls -= 1
+    if not task.cancelled() and task.exception():  # Also marks the exception as retrieved
+        print(f"Speculative scene failed: {task.exception()}")
+
+def finished_speculation(task):  # The speculative scene if it is ready and usable, else None
+    if not task or not task.done() or task.cancelled() or task.exception(): return None
+    scene_text = task.result()
+    return None if scene_text == GEMINI_ERROR_TEXT else scene_text
+
+def speculate(story: StoryContext):  # Start writing the scene for each choice; {} when over budget
+    global speculative_calls
+    if speculative_calls + len(CHOICE_TURNS) > MAX_SPECULATIVE_CALLS: return {}
+    contents, system_instruction = story.contents(), story.system_instruction()
+    speculations = {}
+    for choice, turn in CHOICE_TURNS.items():
+        task = asyncio.create_task(call_gemini_api_async(contents + [gemini_turn("user", turn)], system_instruction))
+        task.add_done_callback(release_speculation)
+        speculative_calls += 1
+        speculations[choice] = task
+    return speculations
+
 # --- WebSocket Logic ---
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, max_active_games):
         self.active_connections: list[WebSocket] = []  # List of active WebSocket connections
+        self.game_slots = asyncio.Semaphore(max_active_games)  # Caps concurrent calls into Gemini / Stable Diffusion
+        self.queue: list[WebSocket] = []  # Players waiting for a free slot, first in line first
+
+    async def send_queue_positions(self):  # Keep every waiting player's "number N in line" current
+        for position, websocket in enumerate(self.queue, start=1):
+            try:
+                await send_message(websocket, {"type": "queued", "position": position})
+            except Exception:
+                pass  # Gone; its own connect() notices and leaves the queue
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()  # Wait for the client to connect
+    async def connect(self, websocket: WebSocket):  # Admit a player; False if they left while queued
+        if not self.game_slots.locked():
+            await self.game_slots.acquire()
+            self.active_connections.append(websocket)  # Add the new connection
+            return True
+        # At capacity: queue the player rather than overload the AI APIs. The client sends nothing
+        # while it waits, so watching the socket tells us if the player gives up and leaves.
+        self.queue.append(websocket)
+        await self.send_queue_positions()
+        admitted = asyncio.create_task(self.game_slots.acquire())
+        left = asyncio.create_task(wait_for_disconnect(websocket))
+        got_slot = False
+        try:
+            await asyncio.wait({admitted, left}, return_when=asyncio.FIRST_COMPLETED)
+            got_slot = admitted.done() and not left.done()
+        finally:
+            left.cancel()
+            self.queue.remove(websocket)
+            if not got_slot:
+                admitted.cancel()
+                if admitted.done() and not admitted.cancelled():
+                    self.game_slots.release()  # Got a slot just as the player left; pass it on
+        await self.send_queue_positions()
+        if not got_slot: return False
         self.active_connections.append(websocket)  # Add the new connection
+        return True
 
     def disconnect(self, websocket: WebSocket):  # Remove the connection
         self.active_connections.remove(websocket) 
+        self.game_slots.release()
 
-manager = ConnectionManager()  # Manage WebSocket connections
+manager = ConnectionManager(MAX_ACTIVE_GAMES)  # Manage WebSocket connections
 
 @app.websocket("/ws/game")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)  # Accept the WebSocket connection
-    story_history = []  # Keep track of the story progression
+    await websocket.accept()  # Wait for the client to connect
+    try:
+        initial_data = await receive_message(websocket)  # Receive initial data from the client
+    except WebSocketDisconnect:
+        return
+    if not await manager.connect(websocket):  # Wait for a free game slot
+        print("Client left the queue.")
+        return
+    story = StoryContext()  # The conversation sent to Gemini each turn
+    image_task = None  # Background visual prompt + image generation for the current scene
+    speculations = {}  # Choice -> task writing the scene that choice leads to
     try:
-        initial_data = await websocket.receive_json()  # Receive initial data from the client
         user_idea = initial_data.get("idea", "a brave adventurer in a mysterious land")  # Get user idea
-        story_history.append(f"The user's character is {user_idea}.") 
 
         # --- INITIAL PROMPT ---
-        initial_prompt = (
-            "You are a text adventure game's Dungeon Master. "
-            f"The user's character and setting is: '{user_idea}'. "
-            "Describe the opening scene vividly. "
-            "Your response MUST end with two clear choices for the user, formatted exactly as 'A) [Choice text]' and 'B) [Choice text]' on separate lines."
-        )
-        
-        scene_text = await call_gemini_api_async(initial_prompt)
-        story_history.append(f"AI Scene: {scene_text}")
-        
-        await websocket.send_json({"type": "story", "text": scene_text})
+        story.append("user", OPENING_TURN.format(idea=user_idea))
         
-        visual_prompt = await generate_visual_prompt_async(scene_text)
-        image_b64 = await generate_image_async(visual_prompt)
-        if image_b64:
-            await websocket.send_json({"type": "image", "data": image_b64})
-
-        while True:
-            data = await websocket.receive_json()
-            user_choice = data.get("choice")
+        # The image renders while the user reads the scene and picks a choice
+        scene_text, image_task = await stream_scene(websocket, story)
+        if scene_text:
+            story.append("model", scene_text)
+            speculations = speculate(story)
+        else:
+            story.retract()
+
+        async for message in websocket.iter_text():  # Ends cleanly when the client disconnects
+            user_choice = orjson.loads(message).get("choice")
             
             if user_choice not in ['A', 'B']: continue
                 
-            story_history.append(f"User chose: {user_choice}")
+            if image_task: image_task.cancel()  # The previous scene's image is stale once the user moves on
+            scene_text = finished_speculation(speculations.get(user_choice))
+            for task in speculations.values(): task.cancel()  # Unfinished branches would only delay the first token
             
-            # --- UPDATED PROMPT ---
-            next_prompt = (
-                "You are a text adventure game's Dungeon Master. Continue the story based on the user's last choice. "
-                "Describe the outcome and the new scene. Keep the story consistent. "
-                "Your response MUST end with two new, clear choices, formatted exactly as 'A) [Choice text]' and 'B) [Choice text]' on separate lines. "
-                f"Here is the story so far:\n{' '.join(story_history)}"
-            )
+            # --- NEXT TURN: only the choice is new ---
+            story.append("user", CHOICE_TURNS[user_choice])
             
-            scene_text = await call_gemini_api_async(next_prompt)
-            story_history.append(f"AI Scene: {scene_text}")
-            
-            await websocket.send_json({"type": "story", "text": scene_text})
-            
-            visual_prompt = await generate_visual_prompt_async(scene_text)
-            image_b64 = await generate_image_async(visual_prompt)
-            if image_b64:
-                await websocket.send_json({"type": "image", "data": image_b64})
+            if scene_text:
+                image_task = await send_scene(websocket, scene_text)
+            else:
+                scene_text, image_task = await stream_scene(websocket, story)
+            if scene_text:
+                story.append("model", scene_text)
+                speculations = speculate(story)
+            else:  # Gemini failed; the player can pick again from the previous scene
+                story.retract()
+                speculations = {}
 
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
         print("Client disconnected.")
+    except WebSocketDisconnect:  # Disconnected mid-scene
+        print("Client disconnected.")
+    finally:
+        manager.disconnect(websocket)  # Always hand the game slot to the next player
+        story.close()
+        for task in speculations.values(): task.cancel()
+        if image_task:
+            image_task.cancel()  # Don't render images for a closed socket
 
 # --- Serve the frontend ---
 